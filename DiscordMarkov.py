@@ -1,7 +1,6 @@
 import discord
 from discord import ChannelType
 import os
-import bisect
 import random
 import pickle
 import configparser
@@ -12,140 +11,9 @@ import re
 import datetime
 from dateutil import tz
 import numpy as np
-from collections import OrderedDict
-
-class MarkovContainer:
-	def __init__(self):
-		# user_id : Markov
-		self.markovs = {}
-		# channel_id : ChannelMetadata
-		self.channels_metadata = {}
-		
-class ChannelMetadata:
-	def __init__(self):
-		# Channel's first ever message's timestamp
-		self.first_message_timestamp = None
-		# List of ranges (tuples) of datetime of messages that have already been processed. Datetime objects are in UTC
-		# Always sorted from greatest to least (newest to oldest)
-		# Guaranteed to contain no overlaps
-		self.processed_timestamp_ranges = []
-		# Last log update's first message processed's timestamp, as a datetime object
-		self.last_update_timestamp = None
-		
-	def add_timestamp_range(self, min_date, max_date):
-		self.processed_timestamp_ranges.append((min_date, max_date))
-		n = len(self.processed_timestamp_ranges)
-		self.processed_timestamp_ranges.sort()
-		
-		stack = []
-		stack.append(self.processed_timestamp_ranges[0])
-		for i in range(n - 1):
-			if stack[len(stack) - 1][1] < self.processed_timestamp_ranges[i + 1][0]:
-				stack.append(self.processed_timestamp_ranges[i + 1])
-			elif stack[len(stack) - 1][1] < self.processed_timestamp_ranges[i + 1][1]:
-				stack[len(stack) - 1] = (stack[len(stack) - 1][0], self.processed_timestamp_ranges[i + 1][1])
-				
-		self.processed_timestamp_ranges.clear()
-		for interval in stack:
-			self.processed_timestamp_ranges.append(stack.pop())
-		
-class Markov:
-	def __init__(self):
-		# Probability distribution of message lengths
-		# message_length : [probability, count]
-		self.message_lengths = OrderedDict()
-		self.total_messages = 0
-	
-		# Probability distribution of starting words
-		# word : [probability, count of that word]
-		self.starters = OrderedDict()
-		
-		# Graph of words
-		# Dictionary of OrderedDicts
-		# word : {next_word : [probability, count of next_word after word]}
-		self.words = {}
-		
-	def add_message(self, message):
-		words_list = message.split()
-		words_count = len(words_list)
-		
-		if words_count == 0:
-			return
-		
-		# Update count of generated messages' lengths
-		self.total_messages = self.total_messages + 1
-		try:
-			self.message_lengths[words_count][1] = self.message_lengths[words_count][1] + 1
-		except KeyError:
-			self.message_lengths[words_count] = [0, 1]
-			
-		# Update count of starters
-		try:
-			self.starters[words_list[0]][1] = self.starters[words_list[0]][1] + 1
-		except KeyError:
-			self.starters[words_list[0]] = [0, 1]
-			
-		# Update counts of all words in message
-		prev = words_list[0]
-		for word in words_list[1:]:
-			if self.words.get(prev) is None:
-				self.words[prev] = OrderedDict()
-		
-			if self.words[prev].get(word) is None:
-				self.words[prev][word] = [0, 1]
-			else:
-				self.words[prev][word][1] = self.words[prev][word][1] + 1
-			prev = word
-		
-	def generate_message(self):
-		# Choose random length
-		r = random.random()
-		length = list(self.message_lengths.items())[bisect.bisect_left([x[0] for x in self.message_lengths.values()], r)][0]
-		length = max(1, int(round(length * message_length_multiplier)))
-		
-		# Choose starting word
-		r = random.random()
-		starter = list(self.starters.items())[bisect.bisect_left([x[0] for x in self.starters.values()], r)][0]
-		message = starter
-		
-		cur_length = 0
-		cur_word = starter
-		while cur_length < length and cur_word in self.words and len(self.words[cur_word]) > 0:
-			r = random.random()
-			next = list(self.words[cur_word].items())[bisect.bisect_left([x[0] for x in self.words[cur_word].values()], r)][0]
-			message += ' ' + next
-			cur_word = next
-			cur_length = cur_length + 1
-		
-		return message
-		
-	def finish_adding_messages(self):
-		# Probabilities must be sorted so that bisect works correctly when picking a weighted random for generating messages
-
-		# Sort by count so that probability is always increasing
-		self.message_lengths = OrderedDict(sorted(self.message_lengths.items(), key=lambda x: x[1][1]))
-		self.starters = OrderedDict(sorted(self.starters.items(), key=lambda x: x[1][1]))
-
-		# Calculate all probabilities of starters/lengths/all_nodes
-		prev_probability = 0
-		for k in self.message_lengths.keys():
-			self.message_lengths[k][0] = prev_probability + self.message_lengths[k][1]/self.total_messages
-			prev_probability = self.message_lengths[k][0]
-		prev_probability = 0
-		for k in self.starters.keys():
-			self.starters[k][0] = prev_probability + self.starters[k][1]/self.total_messages
-			prev_probability = self.starters[k][0]
-						
-		for k in self.words.keys():
-			sum = 0
-			for v in self.words[k].values():
-				sum += v[1]
-				
-			self.words[k] = OrderedDict(sorted(self.words[k].items(), key=lambda x: x[1][1]))
-			prev_probability = 0
-			for k2 in self.words[k].keys():
-				self.words[k][k2][0] = prev_probability + self.words[k][k2][1]/sum
-				prev_probability = self.words[k][k2][0]
+import markov_snapshot
+# Data saved before the Markov classes were moved into markov_model refers to them through this module
+from markov_model import MarkovContainer, ChannelMetadata, Markov, LegacyDataException, scope_key, split_scope_key
 
 class UsernamesContainer:
 	'''
@@ -172,22 +40,40 @@ message_ignore_list = [
 
 markov_c = MarkovContainer()
 usernames_container = UsernamesContainer()
-			
-# Config file
-config = configparser.ConfigParser()
-config.read('config.ini')
-try:
-	message_length_multiplier = float(config['DEFAULT']['MessageLengthMultiplier'])
-except ValueError:
-	print('MessageLengthMultiplier in config.ini must be a float')
-	message_length_multiplier = 1.4
+
+# markov_snapshot.GenerationPool that generates messages from the published snapshot; None if generation is done in this process
+generation_pool = None
+snapshots_published = 0
+# scope : list of ids of the users who have data in that scope in the published snapshot
+snapshot_users = {}
+
+# Config file and Discord client
+# Only set up by the main process because worker processes import this module too
+config = None
+message_length_multiplier = 1.4
+generation_workers = 0
+client = None
 
 BACK_COMMAND = 'b'
 DATA_FOLDER = 'Data'
+SNAPSHOT_FOLDER = 'Snapshots'
 
-client = discord.Client()
+def load_config():
+	global config
+	global message_length_multiplier
+	global generation_workers
+	
+	config = configparser.ConfigParser()
+	config.read('config.ini')
+	try:
+		message_length_multiplier = float(config['DEFAULT']['MessageLengthMultiplier'])
+	except ValueError:
+		print('MessageLengthMultiplier in config.ini must be a float')
+	try:
+		generation_workers = int(config['DEFAULT'].get('GenerationWorkers', '0'))
+	except ValueError:
+		print('GenerationWorkers in config.ini must be an integer')
 	
-@client.event
 async def on_ready():
 	# Preparations in initial login
 	
@@ -222,6 +108,78 @@ async def update_usernames():
 	with open('usernames.pkl', 'wb') as f:
 		pickle.dump(usernames_container, f, pickle.HIGHEST_PROTOCOL)
 		
+async def publish_snapshot():
+	'''
+	Exports the finalized Markovs into a new snapshot for the generation workers.
+	Workers keep serving from the previous snapshot until the new one is fully written.
+	'''
+	global snapshots_published
+	global snapshot_users
+	
+	if generation_pool is None:
+		return
+	
+	if not os.path.exists(SNAPSHOT_FOLDER):
+		os.makedirs(SNAPSHOT_FOLDER)
+	
+	print('Publishing snapshot...')
+	snapshots_published = snapshots_published + 1
+	path = os.path.join(SNAPSHOT_FOLDER, 'snapshot-' + str(snapshots_published) + '.bin')
+	keys = await client.loop.run_in_executor(None, markov_snapshot.write_snapshot, markov_c.scoped_markovs(), path)
+	users = {}
+	for key in keys:
+		uid, scope = split_scope_key(key)
+		users.setdefault(scope, []).append(uid)
+	generation_pool.publish(path)
+	snapshot_users = users
+	print('Published')
+	
+	remove_old_snapshots()
+	
+def remove_old_snapshots():
+	for file in os.listdir(SNAPSHOT_FOLDER):
+		# Only files written by publish_snapshot, including ones left half-written by a crash
+		if not file.startswith('snapshot-') or not (file.endswith('.bin') or file.endswith('.bin.tmp')):
+			continue
+		path = os.path.join(SNAPSHOT_FOLDER, file)
+		# Snapshots that requests were sent against are kept until those requests are done; removed on the next publish
+		if generation_pool.is_in_use(path):
+			continue
+		try:
+			os.remove(path)
+		except OSError:
+			# Still mapped by an idle worker that has not picked up the newest snapshot
+			pass
+	
+async def generate_message(uid, scope=None):
+	'''
+	Generates a message from the Markov of the user with id uid in the scope.
+	Raises KeyError if there is no data on the user in the scope.
+	'''
+	if generation_pool is None or generation_pool.snapshot_path is None:
+		return markov_c.get_markov(uid, scope).generate_message(message_length_multiplier)
+	
+	m = await generation_pool.generate_message(scope_key(uid, scope))
+	if m is None:
+		raise KeyError(uid)
+	return m
+	
+def parse_scope(message):
+	'''
+	Splits the arguments of a /markov command into the target and the scope
+	"[target] in #channel" is scoped to that channel and "[target] in server" to the server the command was sent in
+	'''
+	args = message.content.split('/markov ', 1)[1]
+	parts = args.rsplit(' in ', 1)
+	if len(parts) == 2:
+		scope = parts[1].strip()
+		if scope == 'server' and message.server is not None:
+			return parts[0], ('server', message.server.id), ' in ' + message.server.name
+		for channel in message.channel_mentions:
+			if scope == channel.mention:
+				return parts[0], ('channel', channel.id), ' in #' + channel.name
+	return args, None, ''
+	
 async def save_obj(obj, name):
 	print('Saving data...')
 	with open(name, 'wb') as f:
@@ -250,6 +208,9 @@ async def update_logs(channel, messages_param):
 	except KeyError:
 		markov_c.channels_metadata[channel.id] = ChannelMetadata()
 		metadata = markov_c.channels_metadata[channel.id]
+	metadata.server_id = channel.server.id
+	metadata.name = channel.name
+	metadata.server_name = channel.server.name
 	
 	if isinstance(messages_param, int):		
 		# messages_param is the max number of messages to be processed
@@ -320,11 +281,7 @@ async def update_logs(channel, messages_param):
 			if str(message.timestamp) == str(metadata.last_update_timestamp):
 				break
 				
-			try:
-				markov_c.markovs[message.author.id].add_message(content)
-			except KeyError:
-				markov_c.markovs[message.author.id] = Markov()
-				markov_c.markovs[message.author.id].add_message(content)
+			markov_c.add_message(message.author.id, channel.id, content)
 				
 		min_date = last_message.timestamp
 	# Read unread messages
@@ -364,11 +321,7 @@ async def update_logs(channel, messages_param):
 						
 			messages_processed = messages_processed + 1
 					
-			try:
-				markov_c.markovs[message.author.id].add_message(content)
-			except KeyError:
-				markov_c.markovs[message.author.id] = Markov()
-				markov_c.markovs[message.author.id].add_message(content)
+			markov_c.add_message(message.author.id, channel.id, content)
 				
 		min_date = last_message.timestamp
 	# Read unread messages in a certain range
@@ -417,11 +370,7 @@ async def update_logs(channel, messages_param):
 						
 			messages_processed = messages_processed + 1
 					
-			try:
-				markov_c.markovs[message.author.id].add_message(content)
-			except KeyError:
-				markov_c.markovs[message.author.id] = Markov()
-				markov_c.markovs[message.author.id].add_message(content)
+			markov_c.add_message(message.author.id, channel.id, content)
 		
 	# test
 	print('Read in ' + str(messages_processed) + ' messages')
@@ -436,7 +385,6 @@ async def update_logs(channel, messages_param):
 	
 	metadata.add_timestamp_range(min_date, max_date)
 	
-@client.event
 async def on_message(message):
 	global markov_c
 	global config
@@ -451,27 +399,40 @@ async def on_message(message):
 	if message.content == "/help":
 		msg = '"/markov random" - Random message from random user\n'
 		msg += '"/markov @user" or "/markov username" - Random message from that user\n'
+		msg += 'Add "in #channel" or "in server" to any of the above to only use messages from that channel or this server\n'
 		
 		await client.send_message(message.channel, msg)
-	elif message.content == '/markov random':
-		m = markov_c.markovs[random.choice(list(markov_c.markovs))].generate_message()
-		await client.send_message(message.channel, m)
-	elif message.content.startswith('/markov'):
-		if len(message.mentions) > 0:
+	elif message.content.startswith('/markov '):
+		target, scope, scope_name = parse_scope(message)
+		if target == 'random':
+			if generation_pool is None or generation_pool.snapshot_path is None:
+				uids = markov_c.users_in_scope(scope)
+			else:
+				# Only users in the published snapshot; markov_c can have users that are still being read in
+				uids = snapshot_users.get(scope, [])
 			try:
-				m = markov_c.markovs[message.mentions[0].id].generate_message()
+				if len(uids) == 0:
+					raise KeyError(scope)
+				m = await generate_message(random.choice(uids), scope)
+				await client.send_message(message.channel, m)
+			except KeyError:
+				await client.send_message(message.channel, 'No data' + scope_name)
+		elif len(message.mentions) > 0:
+			try:
+				m = await generate_message(message.mentions[0].id, scope)
 				await client.send_message(message.channel, m)
 			except:
-				await client.send_message(message.channel, 'No data on ' + message.mentions[0].name)
+				await client.send_message(message.channel, 'No data on ' + message.mentions[0].name + scope_name)
 		else:
 			# Check usernames list
-			username = message.content.split('/markov ', 1)[1]
-			uid = usernames_container.get(username)
-			if uid != None:
-				m = markov_c.markovs[uid].generate_message()
+			uid = usernames_container.get(target)
+			try:
+				if uid is None:
+					raise KeyError(target)
+				m = await generate_message(uid, scope)
 				await client.send_message(message.channel, m)
-			else:
-				await client.send_message(message.channel, 'No data on ' + username)
+			except KeyError:
+				await client.send_message(message.channel, 'No data on ' + target + scope_name)
 
 def line():
 	print('------------------------------')
@@ -479,6 +440,7 @@ def line():
 async def load_markovs(file_name):
 	global markov_c
 	markov_c = await load_obj(file_name)
+	await publish_snapshot()
 	
 async def input_with_back(prompt):
 	print(prompt)
@@ -532,7 +494,7 @@ async def ask_load_file_name():
 async def main_menu():
 	line()
 	try:
-		mode = await input_with_back('1. Read messages from Discord\n2. Load existing data\n3. Save current data')
+		mode = await input_with_back('1. Read messages from Discord\n2. Load existing data\n3. Save current data\n4. Remove data from channel(s)')
 	except BackInputException:
 		quit()
 
@@ -552,6 +514,8 @@ async def main_menu():
 			await main_menu()
 			return
 		await save_obj(markov_c, file_name)
+	elif mode == '4':
+		await remove_channels_menu()
 	else:
 		print('Invalid input')
 		await main_menu()
@@ -561,8 +525,14 @@ async def read_from_all_channels(messages_to_process):
 		for channel in server.channels:
 			if (channel.type == ChannelType.text or channel.type == ChannelType.group) and channel.permissions_for(server.me).read_messages:
 				await update_logs(channel, messages_to_process)
-	for k in markov_c.markovs.keys():
-		markov_c.markovs[k].finish_adding_messages()
+	await finish_reading()
+	
+async def finish_reading():
+	'''
+	Finalizes the shards that messages were read into and updates the aggregates of their users
+	'''
+	markov_c.update_aggregates()
+	await publish_snapshot()
 						
 async def prompt_message_processing():
 	prompt = ('Enter number of messages to be processed or enter a dash-separated range of times in which all messages are processed.\n'
@@ -627,7 +597,11 @@ async def read_mode_menu():
 		print('Invalid input')
 		await read_mode_menu()
 		
-async def channel_choice_menu():
+async def choose_channels():
+	'''
+	Lists every readable channel and returns the set of channels the user picks
+	Raises KeyError on invalid input
+	'''
 	line()
 	s = 1
 	choices = {}
@@ -648,18 +622,22 @@ async def channel_choice_menu():
 					c = ord('a')
 		s = s + 1
 	
+	choice = await input_with_back('Pick the server(s)/channel(s) to read from, space-separated\nExample: "1b 1e 2a 3" will pick channels 1b, 1e, 2a, and all channels in 3')
+	line()
+	chosen = set()
+	for s in choice.split():
+		# If no alphabet in string, then it is a server selection
+		if re.search('[a-zA-Z]', s):
+			chosen.add(choices[s])
+		else:
+			for channel in choices[s].channels:
+				if (channel.type == ChannelType.text or channel.type == ChannelType.group) and channel.permissions_for(choices[s].me).read_messages: 
+					chosen.add(channel)
+	return chosen
+	
+async def channel_choice_menu():
 	try:
-		choice = await input_with_back('Pick the server(s)/channel(s) to read from, space-separated\nExample: "1b 1e 2a 3" will pick channels 1b, 1e, 2a, and all channels in 3')
-		line()
-		read_from = set()
-		for s in choice.split():
-			# If no alphabet in string, then it is a server selection
-			if re.search('[a-zA-Z]', s):
-				read_from.add(choices[s])
-			else:
-				for channel in choices[s].channels:
-					if (channel.type == ChannelType.text or channel.type == ChannelType.group) and channel.permissions_for(server.me).read_messages: 
-						read_from.add(channel)
+		read_from = await choose_channels()
 				
 		messages_to_process = await prompt_message_processing()
 		line()
@@ -667,8 +645,7 @@ async def channel_choice_menu():
 		# Read in channels
 		for channel in read_from:
 			await update_logs(channel, messages_to_process)
-		for k in markov_c.markovs.keys():
-			markov_c.markovs[k].finish_adding_messages()
+		await finish_reading()
 	except BackInputException:
 		await read_mode_menu()
 		return
@@ -677,6 +654,55 @@ async def channel_choice_menu():
 		await channel_choice_menu()
 	return None
 	
+def channel_display_name(channel_id):
+	if channel_id is None:
+		return 'Data saved before messages were stored per channel'
+	metadata = markov_c.channels_metadata.get(channel_id)
+	if metadata is not None and metadata.name is not None:
+		return metadata.server_name + '/#' + metadata.name
+	channel = client.get_channel(channel_id)
+	if channel is not None:
+		return channel.server.name + '/#' + channel.name
+	return 'Unknown channel ' + channel_id
+	
+async def remove_channels_menu():
+	'''
+	Only the shards of the removed channels are dropped; the channels can then be read again from scratch
+	Lists every channel that has data, including deleted or unreadable channels and channels of servers the bot has left
+	'''
+	line()
+	channels = sorted(markov_c.stored_channels(), key=channel_display_name)
+	if len(channels) == 0:
+		print('No data to remove')
+		return
+	choices = {}
+	for i, channel_id in enumerate(channels, 1):
+		print(str(i) + '. ' + channel_display_name(channel_id))
+		choices[str(i)] = channel_id
+		
+	try:
+		choice = await input_with_back('Pick the channel(s) to remove data from, space-separated\nExample: "1 3" will pick channels 1 and 3')
+		remove_from = set(choices[s] for s in choice.split())
+	except BackInputException:
+		await main_menu()
+		return
+	except KeyError:
+		print('Invalid input')
+		await remove_channels_menu()
+		return
+	line()
+		
+	removed = 0
+	for channel_id in remove_from:
+		try:
+			markov_c.remove_channel(channel_id)
+			removed = removed + 1
+		except LegacyDataException:
+			print('Cannot remove data from ' + channel_display_name(channel_id) + ': it was read before messages were stored per channel')
+	markov_c.update_aggregates()
+	print('Removed data from ' + str(removed) + ' channel(s)')
+	await publish_snapshot()
+	
 async def prompt_int(prompt):
 	'''
 	Prompts user for an integer >= 0
@@ -691,4 +717,14 @@ async def prompt_int(prompt):
 	except BackInputException:
 		raise BackInputException
 
-client.run(config['DEFAULT']['APIKey'])
\ No newline at end of file
+if __name__ == '__main__':
+	# Worker processes import this module too, so only the main process may start the bot
+	load_config()
+	client = discord.Client()
+	client.event(on_ready)
+	client.event(on_message)
+	if generation_workers > 0:
+		generation_pool = markov_snapshot.GenerationPool(generation_workers, client.loop, message_length_multiplier)
+		if os.path.exists(SNAPSHOT_FOLDER):
+			remove_old_snapshots()
+	client.run(config['DEFAULT']['APIKey'])
@@ -0,0 +1,85 @@
+'''
+Measures how many messages per second the generation workers serve from a snapshot
+with different numbers of worker processes, compared to generating in a single process.
+All requests are sent at once, the same as a burst of commands.
+Usage: python benchmark.py [users] [messages per user] [requests] [worker counts]
+Worker counts are comma-separated, for example "1,2,4,8"; by default powers of 2 up to the number of CPU cores.
+'''
+
+import os
+import sys
+import random
+import time
+import tempfile
+import asyncio
+import markov_snapshot
+from markov_model import Markov
+
+# Same as the default MessageLengthMultiplier in config.ini
+message_length_multiplier = 1.4
+
+def build_markovs(users, messages_per_user):
+	vocabulary = ['word' + str(i) for i in range(5000)]
+	markovs = {}
+	for uid in range(users):
+		markov = Markov()
+		for i in range(messages_per_user):
+			markov.add_message(' '.join(random.choice(vocabulary) for j in range(random.randint(1, 30))))
+		markov.finish_adding_messages()
+		markovs[str(uid)] = markov
+	return markovs
+
+def benchmark_in_process(path, keys, requests):
+	snapshot = markov_snapshot.MarkovSnapshot(path)
+	start = time.perf_counter()
+	for i in range(requests):
+		snapshot.generate_message(random.choice(keys), message_length_multiplier)
+	elapsed = time.perf_counter() - start
+	snapshot.close()
+	return requests / elapsed
+
+async def generate_all(pool, keys, requests):
+	await asyncio.gather(*[pool.generate_message(random.choice(keys)) for i in range(requests)])
+
+def benchmark_pool(path, keys, workers, requests):
+	loop = asyncio.new_event_loop()
+	pool = markov_snapshot.GenerationPool(workers, loop, message_length_multiplier)
+	pool.publish(path)
+	# Start every worker and map the snapshot before timing
+	loop.run_until_complete(generate_all(pool, keys, workers * 4))
+
+	start = time.perf_counter()
+	loop.run_until_complete(generate_all(pool, keys, requests))
+	elapsed = time.perf_counter() - start
+	pool.shutdown()
+	loop.close()
+	return requests / elapsed
+
+def main():
+	users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+	messages_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+	requests = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+	if len(sys.argv) > 4:
+		worker_counts = [int(workers) for workers in sys.argv[4].split(',')]
+	else:
+		worker_counts = [1]
+		while worker_counts[-1] * 2 <= os.cpu_count():
+			worker_counts.append(worker_counts[-1] * 2)
+
+	print(str(os.cpu_count()) + ' CPU core(s)')
+
+	print('Building ' + str(users) + ' Markovs from ' + str(messages_per_user) + ' messages each...')
+	markovs = build_markovs(users, messages_per_user)
+
+	path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+	keys = markov_snapshot.write_snapshot(markovs, path)
+	print('Snapshot size: ' + str(os.path.getsize(path) // 1024) + ' KiB')
+
+	print('In process: ' + str(int(benchmark_in_process(path, keys, requests))) + ' messages/s')
+	for workers in worker_counts:
+		print(str(workers) + ' worker(s): ' + str(int(benchmark_pool(path, keys, workers, requests))) + ' messages/s')
+
+	os.remove(path)
+
+if __name__ == '__main__':
+	main()
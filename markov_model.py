@@ -0,0 +1,437 @@
+'''
+Markov chain data read in from Discord messages.
+Kept free of Discord so that generation worker processes and benchmark.py can import it.
+'''
+
+import bisect
+import random
+from collections import OrderedDict
+
+class LegacyDataException(Exception):
+	pass
+	
+class MarkovContainer:
+	'''
+	Messages are counted in one shard per user per channel. Per-user and per-server Markovs are aggregates of the shards.
+	Shards that change are recorded until update_aggregates, which only finalizes those shards and adds or subtracts
+	their changed counts to or from the aggregates they are part of. An aggregate made of a single shard is that shard itself.
+	Only the shards and channel metadata are saved; the aggregates and indexes are rebuilt from them when loading.
+	
+	A scope is None for all of a user's messages, ('server', server_id) or ('channel', channel_id)
+	'''
+	def __init__(self):
+		# (user_id, channel_id) : Markov
+		self.shards = {}
+		# channel_id : ChannelMetadata
+		self.channels_metadata = {}
+		self.clear_aggregates()
+		
+	def clear_aggregates(self):
+		# user_id : Markov of all of the user's shards
+		self.markovs = {}
+		# user_id : {server_id : Markov of the user's shards in that server}
+		self.server_markovs = {}
+		# user_id : set of ids of the channels the user has shards in
+		self.user_channels = {}
+		# channel_id : set of ids of the users with shards in that channel
+		self.channel_users = {}
+		# server_id : set of ids of the users with shards in that server
+		self.server_users = {}
+		# (user_id, channel_id) : Markov of the messages added to that shard since the last update_aggregates
+		self.pending = {}
+		# List of (user_id, server_id, Markov) of shards removed since the last update_aggregates
+		self.removed = []
+		
+	def __getstate__(self):
+		# Everything else is derived from these; saving the aggregates would save every count again
+		return {'shards': self.shards, 'channels_metadata': self.channels_metadata}
+		
+	def __setstate__(self, state):
+		self.channels_metadata = state['channels_metadata']
+		if 'shards' in state:
+			self.shards = state['shards']
+		else:
+			# Data saved before messages were split by channel; its messages are kept in a shard of an unknown channel
+			self.shards = {(uid, None): markov for uid, markov in state['markovs'].items()}
+			
+		self.clear_aggregates()
+		for (uid, cid), markov in self.shards.items():
+			self.user_channels.setdefault(uid, set()).add(cid)
+			self.channel_users.setdefault(cid, set()).add(uid)
+			# Every shard counts as new so that all aggregates are built
+			self.pending[(uid, cid)] = markov
+		self.update_aggregates()
+		
+	def add_message(self, uid, channel_id, message):
+		try:
+			self.shards[(uid, channel_id)].add_message(message)
+		except KeyError:
+			self.shards[(uid, channel_id)] = Markov()
+			self.shards[(uid, channel_id)].add_message(message)
+			self.user_channels.setdefault(uid, set()).add(channel_id)
+			self.channel_users.setdefault(channel_id, set()).add(uid)
+		try:
+			self.pending[(uid, channel_id)].add_message(message)
+		except KeyError:
+			self.pending[(uid, channel_id)] = Markov()
+			self.pending[(uid, channel_id)].add_message(message)
+			
+	def remove_channel(self, channel_id):
+		'''
+		Removes all messages read from a channel so that it can be read again from scratch
+		The aggregates are updated on the next update_aggregates
+		Raises LegacyDataException if the channel was read before messages were split by channel and that data is still here,
+		since its messages cannot be told apart from the rest of it and reading the channel again would count them twice
+		'''
+		metadata = self.channels_metadata.get(channel_id)
+		if metadata is not None and metadata.read_before_split and self.has_legacy_data():
+			raise LegacyDataException
+			
+		server_id = self.server_of(channel_id)
+		for uid in self.channel_users.pop(channel_id, set()):
+			markov = self.shards.pop((uid, channel_id))
+			self.user_channels[uid].discard(channel_id)
+			# The aggregates never had the messages that are still pending
+			pending = self.pending.pop((uid, channel_id), None)
+			if pending is not None:
+				markov.subtract(pending)
+			self.removed.append((uid, server_id, markov))
+		self.channels_metadata.pop(channel_id, None)
+		
+	def stored_channels(self):
+		'''
+		Returns the ids of all channels that have been read, including ones the bot can no longer see
+		None stands for the data saved before messages were split by channel
+		'''
+		return set(self.channels_metadata.keys()) | set(self.channel_users.keys())
+		
+	def has_legacy_data(self):
+		return None in self.channel_users
+			
+	def update_aggregates(self):
+		'''
+		Finalizes the shards that changed since the last call and updates the aggregates of their users
+		'''
+		# user_id : list of (server_id, Markov of changed counts, True if the counts were added or False if removed)
+		changes = {}
+		for (uid, cid), pending in self.pending.items():
+			self.shards[(uid, cid)].finish_adding_messages()
+			changes.setdefault(uid, []).append((self.server_of(cid), pending, True))
+		for uid, server_id, markov in self.removed:
+			changes.setdefault(uid, []).append((server_id, markov, False))
+		self.pending = {}
+		self.removed = []
+		
+		for uid, user_changes in changes.items():
+			# channel_id : Markov
+			shards = {cid: self.shards[(uid, cid)] for cid in self.user_channels.get(uid, ())}
+			# Aggregates that are one of these are shared and cannot be updated in place
+			shared = list(shards.values()) + [markov for server_id, markov, added in user_changes if not added]
+			
+			old_markov = self.markovs.pop(uid, None)
+			markov = self._update_aggregate(old_markov, list(shards.values()), user_changes, shared)
+			if markov is not None:
+				self.markovs[uid] = markov
+			else:
+				self.user_channels.pop(uid, None)
+			
+			# server_id : [Markov]
+			servers = {}
+			for cid, shard in shards.items():
+				server_id = self.server_of(cid)
+				if server_id is not None:
+					servers.setdefault(server_id, []).append(shard)
+			old_server_markovs = self.server_markovs.pop(uid, {})
+			for server_id in old_server_markovs.keys():
+				self.server_users[server_id].discard(uid)
+				if len(self.server_users[server_id]) == 0:
+					del self.server_users[server_id]
+			if len(servers) == 0:
+				continue
+				
+			server_markovs = {}
+			for server_id, server_shards in servers.items():
+				if len(server_shards) == len(shards):
+					server_markovs[server_id] = markov
+				else:
+					server_changes = [change for change in user_changes if change[0] == server_id]
+					server_markovs[server_id] = self._update_aggregate(old_server_markovs.get(server_id), server_shards, server_changes, shared + [old_markov])
+				self.server_users.setdefault(server_id, set()).add(uid)
+			self.server_markovs[uid] = server_markovs
+					
+	@staticmethod
+	def _update_aggregate(aggregate, shards, changes, shared):
+		'''
+		Returns the finalized aggregate of shards
+		The previous aggregate is updated with the changes unless it is None or one of shared, in which case it is rebuilt
+		'''
+		if len(shards) == 0:
+			return None
+		if len(shards) == 1:
+			return shards[0]
+		if aggregate is None or any(aggregate is markov for markov in shared):
+			return Markov.aggregate(shards)
+		for server_id, markov, added in changes:
+			if added:
+				aggregate.merge(markov)
+			else:
+				aggregate.subtract(markov)
+		aggregate.finish_adding_messages()
+		return aggregate
+		
+	def server_of(self, channel_id):
+		try:
+			return self.channels_metadata[channel_id].server_id
+		except KeyError:
+			return None
+			
+	def get_markov(self, uid, scope):
+		'''
+		Raises KeyError if the user has no messages in the scope
+		'''
+		if scope is None:
+			return self.markovs[uid]
+		elif scope[0] == 'server':
+			return self.server_markovs[uid][scope[1]]
+		else:
+			return self.shards[(uid, scope[1])]
+			
+	def users_in_scope(self, scope):
+		if scope is None:
+			return list(self.markovs.keys())
+		elif scope[0] == 'server':
+			return list(self.server_users.get(scope[1], ()))
+		else:
+			return list(self.channel_users.get(scope[1], ()))
+			
+	def scoped_markovs(self):
+		'''
+		Returns a dictionary of scope_key : Markov of every Markov in every scope
+		'''
+		ret = {}
+		for uid, markov in self.markovs.items():
+			ret[scope_key(uid, None)] = markov
+		for uid, server_markovs in self.server_markovs.items():
+			for server_id, markov in server_markovs.items():
+				ret[scope_key(uid, ('server', server_id))] = markov
+		for (uid, cid), markov in self.shards.items():
+			if cid is not None:
+				ret[scope_key(uid, ('channel', cid))] = markov
+		return ret
+		
+def scope_key(uid, scope):
+	if scope is None:
+		return uid
+	return uid + '/' + scope[0] + '/' + scope[1]
+	
+def split_scope_key(key):
+	'''
+	Returns the (user_id, scope) a scope_key was made from
+	'''
+	parts = key.split('/')
+	if len(parts) == 1:
+		return key, None
+	return parts[0], (parts[1], parts[2])
+		
+class ChannelMetadata:
+	def __init__(self):
+		# Id of the server the channel is in
+		self.server_id = None
+		# Names of the channel and its server when it was last read, for channels the bot can no longer see
+		self.name = None
+		self.server_name = None
+		# True if the channel was read before messages were split by channel, so its messages are in a shard of an unknown channel
+		self.read_before_split = False
+		# Channel's first ever message's timestamp
+		self.first_message_timestamp = None
+		# List of ranges (tuples) of datetime of messages that have already been processed. Datetime objects are in UTC
+		# Always sorted from greatest to least (newest to oldest)
+		# Guaranteed to contain no overlaps
+		self.processed_timestamp_ranges = []
+		# Last log update's first message processed's timestamp, as a datetime object
+		self.last_update_timestamp = None
+		
+	def __setstate__(self, state):
+		# Metadata saved before messages were split by channel has no server_id
+		state.setdefault('read_before_split', 'server_id' not in state)
+		state.setdefault('server_id', None)
+		state.setdefault('name', None)
+		state.setdefault('server_name', None)
+		self.__dict__.update(state)
+		
+	def add_timestamp_range(self, min_date, max_date):
+		self.processed_timestamp_ranges.append((min_date, max_date))
+		n = len(self.processed_timestamp_ranges)
+		self.processed_timestamp_ranges.sort()
+		
+		stack = []
+		stack.append(self.processed_timestamp_ranges[0])
+		for i in range(n - 1):
+			if stack[len(stack) - 1][1] < self.processed_timestamp_ranges[i + 1][0]:
+				stack.append(self.processed_timestamp_ranges[i + 1])
+			elif stack[len(stack) - 1][1] < self.processed_timestamp_ranges[i + 1][1]:
+				stack[len(stack) - 1] = (stack[len(stack) - 1][0], self.processed_timestamp_ranges[i + 1][1])
+				
+		self.processed_timestamp_ranges.clear()
+		for interval in stack:
+			self.processed_timestamp_ranges.append(stack.pop())
+		
+class Markov:
+	def __init__(self):
+		# Probability distribution of message lengths
+		# message_length : [probability, count]
+		self.message_lengths = OrderedDict()
+		self.total_messages = 0
+	
+		# Probability distribution of starting words
+		# word : [probability, count of that word]
+		self.starters = OrderedDict()
+		
+		# Graph of words
+		# Dictionary of OrderedDicts
+		# word : {next_word : [probability, count of next_word after word]}
+		self.words = {}
+		
+	def add_message(self, message):
+		words_list = message.split()
+		words_count = len(words_list)
+		
+		if words_count == 0:
+			return
+		
+		# Update count of generated messages' lengths
+		self.total_messages = self.total_messages + 1
+		try:
+			self.message_lengths[words_count][1] = self.message_lengths[words_count][1] + 1
+		except KeyError:
+			self.message_lengths[words_count] = [0, 1]
+			
+		# Update count of starters
+		try:
+			self.starters[words_list[0]][1] = self.starters[words_list[0]][1] + 1
+		except KeyError:
+			self.starters[words_list[0]] = [0, 1]
+			
+		# Update counts of all words in message
+		prev = words_list[0]
+		for word in words_list[1:]:
+			if self.words.get(prev) is None:
+				self.words[prev] = OrderedDict()
+		
+			if self.words[prev].get(word) is None:
+				self.words[prev][word] = [0, 1]
+			else:
+				self.words[prev][word][1] = self.words[prev][word][1] + 1
+			prev = word
+		
+	def merge(self, other):
+		'''
+		Adds the counts of another Markov to this one
+		finish_adding_messages must be called afterwards
+		'''
+		self.total_messages = self.total_messages + other.total_messages
+		for k, v in other.message_lengths.items():
+			try:
+				self.message_lengths[k][1] = self.message_lengths[k][1] + v[1]
+			except KeyError:
+				self.message_lengths[k] = [0, v[1]]
+		for k, v in other.starters.items():
+			try:
+				self.starters[k][1] = self.starters[k][1] + v[1]
+			except KeyError:
+				self.starters[k] = [0, v[1]]
+		for k, next_words in other.words.items():
+			if self.words.get(k) is None:
+				self.words[k] = OrderedDict()
+			for k2, v in next_words.items():
+				try:
+					self.words[k][k2][1] = self.words[k][k2][1] + v[1]
+				except KeyError:
+					self.words[k][k2] = [0, v[1]]
+					
+	def subtract(self, other):
+		'''
+		Removes the counts of another Markov whose messages were all added to this one
+		finish_adding_messages must be called afterwards
+		'''
+		self.total_messages = self.total_messages - other.total_messages
+		for k, v in other.message_lengths.items():
+			self.message_lengths[k][1] = self.message_lengths[k][1] - v[1]
+			if self.message_lengths[k][1] == 0:
+				del self.message_lengths[k]
+		for k, v in other.starters.items():
+			self.starters[k][1] = self.starters[k][1] - v[1]
+			if self.starters[k][1] == 0:
+				del self.starters[k]
+		for k, next_words in other.words.items():
+			for k2, v in next_words.items():
+				self.words[k][k2][1] = self.words[k][k2][1] - v[1]
+				if self.words[k][k2][1] == 0:
+					del self.words[k][k2]
+			if len(self.words[k]) == 0:
+				del self.words[k]
+					
+	@staticmethod
+	def aggregate(markovs):
+		'''
+		Returns a finalized Markov of all messages in markovs, which must already be finalized
+		A single Markov is returned as is instead of being copied
+		'''
+		markovs = list(markovs)
+		if len(markovs) == 1:
+			return markovs[0]
+		ret = Markov()
+		for markov in markovs:
+			ret.merge(markov)
+		ret.finish_adding_messages()
+		return ret
+		
+	def generate_message(self, length_multiplier):
+		# Choose random length
+		r = random.random()
+		length = list(self.message_lengths.items())[bisect.bisect_left([x[0] for x in self.message_lengths.values()], r)][0]
+		length = max(1, int(round(length * length_multiplier)))
+		
+		# Choose starting word
+		r = random.random()
+		starter = list(self.starters.items())[bisect.bisect_left([x[0] for x in self.starters.values()], r)][0]
+		message = starter
+		
+		cur_length = 0
+		cur_word = starter
+		while cur_length < length and cur_word in self.words and len(self.words[cur_word]) > 0:
+			r = random.random()
+			next = list(self.words[cur_word].items())[bisect.bisect_left([x[0] for x in self.words[cur_word].values()], r)][0]
+			message += ' ' + next
+			cur_word = next
+			cur_length = cur_length + 1
+		
+		return message
+		
+	def finish_adding_messages(self):
+		# Probabilities must be sorted so that bisect works correctly when picking a weighted random for generating messages
+
+		# Sort by count so that probability is always increasing
+		self.message_lengths = OrderedDict(sorted(self.message_lengths.items(), key=lambda x: x[1][1]))
+		self.starters = OrderedDict(sorted(self.starters.items(), key=lambda x: x[1][1]))
+
+		# Calculate all probabilities of starters/lengths/all_nodes
+		prev_probability = 0
+		for k in self.message_lengths.keys():
+			self.message_lengths[k][0] = prev_probability + self.message_lengths[k][1]/self.total_messages
+			prev_probability = self.message_lengths[k][0]
+		prev_probability = 0
+		for k in self.starters.keys():
+			self.starters[k][0] = prev_probability + self.starters[k][1]/self.total_messages
+			prev_probability = self.starters[k][0]
+						
+		for k in self.words.keys():
+			sum = 0
+			for v in self.words[k].values():
+				sum += v[1]
+				
+			self.words[k] = OrderedDict(sorted(self.words[k].items(), key=lambda x: x[1][1]))
+			prev_probability = 0
+			for k2 in self.words[k].keys():
+				self.words[k][k2][0] = prev_probability + self.words[k][k2][1]/sum
+				prev_probability = self.words[k][k2][0]
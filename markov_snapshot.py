@@ -0,0 +1,326 @@
+'''
+Finalized Markov models exported into a single flat file that generation worker processes
+map into memory read-only. Every worker maps the same file, so the OS page cache holds one
+copy of the data no matter how many workers there are, and nothing is unpickled or copied
+when a worker picks up a new snapshot.
+
+File layout:
+	8 bytes   magic
+	8 bytes   header length (little-endian unsigned)
+	header    JSON with the model index of every key and the (format, offset, count) of every section
+	padding   up to a multiple of 8
+	sections  flat arrays, each starting on a multiple of 8, offsets relative to here
+'''
+
+import os
+import bisect
+import random
+import mmap
+import json
+import struct
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+MAGIC = b'MKVSNAP1'
+PREAMBLE = struct.Struct('<8sQ')
+
+# Section name : array typecode
+# Sections are written in this order
+SECTIONS = OrderedDict([
+	# Word i is word_bytes[word_offsets[i]:word_offsets[i + 1]] encoded as utf-8
+	('word_offsets', 'q'),
+	('word_bytes', 'B'),
+	# MODEL_FIELDS entries per model, see write_snapshot
+	('models', 'q'),
+	# Message lengths and starters of every model, each paired with its cumulative probability
+	('length_values', 'i'),
+	('length_probabilities', 'd'),
+	('starter_words', 'i'),
+	('starter_probabilities', 'd'),
+	# Words that have at least one next word, sorted by word id within each model
+	('node_words', 'i'),
+	# Edges of node i are edge_words[node_edges[i]:node_edges[i + 1]]
+	('node_edges', 'q'),
+	('edge_words', 'i'),
+	('edge_probabilities', 'd')
+])
+MODEL_FIELDS = 6
+
+def _align(n):
+	return (n + 7) & ~7
+
+def write_snapshot(markovs, path):
+	'''
+	Writes all finalized Markovs into a snapshot at path and returns the list of keys written.
+	markovs is a dictionary of key : Markov, where keys are strings.
+	A Markov stored under several keys is only written once.
+	The file is written next to path and renamed over it, so a reader never sees a partial snapshot.
+	'''
+	word_ids = {}
+	sections = OrderedDict((name, array(typecode)) for name, typecode in SECTIONS.items())
+	word_offsets = sections['word_offsets']
+	word_bytes = sections['word_bytes']
+	word_offsets.append(0)
+
+	def word_id(word):
+		try:
+			return word_ids[word]
+		except KeyError:
+			word_ids[word] = len(word_ids)
+			word_bytes.frombytes(word.encode('utf-8'))
+			word_offsets.append(len(word_bytes))
+			return word_ids[word]
+
+	# key : index of the model in models
+	keys = OrderedDict()
+	# id of Markov : index of the model in models
+	written = {}
+	sections['node_edges'].append(0)
+	for key, markov in markovs.items():
+		# Nothing can be generated from a Markov without any messages
+		if len(markov.message_lengths) == 0 or len(markov.starters) == 0:
+			continue
+		if id(markov) in written:
+			keys[key] = written[id(markov)]
+			continue
+		keys[key] = written[id(markov)] = len(written)
+
+		row = [len(sections['length_values'])]
+		for length, (probability, count) in markov.message_lengths.items():
+			sections['length_values'].append(length)
+			sections['length_probabilities'].append(probability)
+		row.append(len(sections['length_values']))
+
+		row.append(len(sections['starter_words']))
+		for word, (probability, count) in markov.starters.items():
+			sections['starter_words'].append(word_id(word))
+			sections['starter_probabilities'].append(probability)
+		row.append(len(sections['starter_words']))
+
+		row.append(len(sections['node_words']))
+		nodes = sorted((word_id(word), next_words) for word, next_words in markov.words.items())
+		for node_word, next_words in nodes:
+			sections['node_words'].append(node_word)
+			# Edges keep the order of the OrderedDict so that the cumulative probabilities stay increasing
+			for next_word, (probability, count) in next_words.items():
+				sections['edge_words'].append(word_id(next_word))
+				sections['edge_probabilities'].append(probability)
+			sections['node_edges'].append(len(sections['edge_words']))
+		row.append(len(sections['node_words']))
+
+		sections['models'].extend(row)
+
+	directory = OrderedDict()
+	offset = 0
+	for name, values in sections.items():
+		directory[name] = [values.typecode, offset, len(values)]
+		offset = _align(offset + len(values) * values.itemsize)
+	header = json.dumps({'keys': keys, 'sections': directory}).encode('utf-8')
+
+	temp_path = path + '.tmp'
+	with open(temp_path, 'wb') as f:
+		f.write(PREAMBLE.pack(MAGIC, len(header)))
+		f.write(header)
+		f.write(b'\0' * (_align(f.tell()) - f.tell()))
+		data_start = f.tell()
+		for name, values in sections.items():
+			f.write(b'\0' * (data_start + directory[name][1] - f.tell()))
+			values.tofile(f)
+	os.replace(temp_path, path)
+
+	return list(keys)
+
+class MarkovSnapshot:
+	'''
+	Read-only view of a snapshot written by write_snapshot.
+	Sections are memoryviews directly over the mapped file; nothing is copied out of it.
+	'''
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self._buffer = memoryview(self._mmap)
+
+		magic, header_length = PREAMBLE.unpack_from(self._mmap, 0)
+		if magic != MAGIC:
+			self.close()
+			raise ValueError(path + ' is not a Markov snapshot')
+		header = json.loads(bytes(self._buffer[PREAMBLE.size:PREAMBLE.size + header_length]).decode('utf-8'))
+		data_start = _align(PREAMBLE.size + header_length)
+
+		# Every memoryview must be released before the mmap can be closed
+		self._views = []
+		for name, (typecode, offset, count) in header['sections'].items():
+			start = data_start + offset
+			raw = self._buffer[start:start + count * array(typecode).itemsize]
+			view = raw.cast(typecode)
+			self._views.append(raw)
+			self._views.append(view)
+			setattr(self, name, view)
+
+		# key : index of the model in models
+		self._model_indices = header['keys']
+		self.keys = list(self._model_indices)
+
+	def close(self):
+		for view in reversed(getattr(self, '_views', [])):
+			view.release()
+		self._views = []
+		self._buffer.release()
+		self._mmap.close()
+
+	def _word(self, word):
+		return bytes(self.word_bytes[self.word_offsets[word]:self.word_offsets[word + 1]]).decode('utf-8')
+
+	@staticmethod
+	def _pick(probabilities, lo, hi):
+		# Weighted random index in [lo, hi); floating point error can leave the last cumulative probability just under 1
+		return min(bisect.bisect_left(probabilities, random.random(), lo, hi), hi - 1)
+
+	def generate_message(self, key, length_multiplier):
+		'''
+		Same as Markov.generate_message for the model stored under key.
+		Returns None if the snapshot has no model for key.
+		'''
+		index = self._model_indices.get(key)
+		if index is None:
+			return None
+		lengths_start, lengths_end, starters_start, starters_end, nodes_start, nodes_end = self.models[index * MODEL_FIELDS:(index + 1) * MODEL_FIELDS]
+
+		# Choose random length
+		length = self.length_values[self._pick(self.length_probabilities, lengths_start, lengths_end)]
+		length = max(1, int(round(length * length_multiplier)))
+
+		# Choose starting word
+		cur_word = self.starter_words[self._pick(self.starter_probabilities, starters_start, starters_end)]
+		message = [self._word(cur_word)]
+
+		cur_length = 0
+		while cur_length < length:
+			node = bisect.bisect_left(self.node_words, cur_word, nodes_start, nodes_end)
+			if node == nodes_end or self.node_words[node] != cur_word:
+				break
+			edges_start = self.node_edges[node]
+			edges_end = self.node_edges[node + 1]
+			if edges_start == edges_end:
+				break
+			cur_word = self.edge_words[self._pick(self.edge_probabilities, edges_start, edges_end)]
+			message.append(self._word(cur_word))
+			cur_length = cur_length + 1
+
+		return ' '.join(message)
+
+# Snapshot currently mapped by this worker process
+_snapshot = None
+# Process that last seeded random; forked workers start with identical random states
+_seeded_pid = None
+
+def generate_message(path, key, length_multiplier):
+	'''
+	Entry point for generation worker processes.
+	Maps the snapshot at path, replacing the previously mapped one if a newer snapshot has been published,
+	and generates a message from the model stored under key. Returns None if there is no such model.
+	'''
+	global _snapshot
+	global _seeded_pid
+
+	if _seeded_pid != os.getpid():
+		random.seed()
+		_seeded_pid = os.getpid()
+
+	if _snapshot is None or _snapshot.path != path:
+		if _snapshot is not None:
+			_snapshot.close()
+			_snapshot = None
+		_snapshot = MarkovSnapshot(path)
+	return _snapshot.generate_message(key, length_multiplier)
+
+def generate_messages(path, keys, length_multiplier):
+	'''
+	Entry point for generation worker processes; generate_message for every key in a batch of requests
+	'''
+	return [generate_message(path, key, length_multiplier) for key in keys]
+
+class GenerationPool:
+	'''
+	Sends generation requests to worker processes.
+	Requests that arrive while every worker is busy are sent together in one batch once a worker is free,
+	so that under load one round trip to a worker is shared by many requests.
+	Keeps count of the batches sent against every snapshot so that a snapshot is never removed while it is in use.
+	'''
+	def __init__(self, workers, loop, length_multiplier):
+		self.workers = workers
+		self.loop = loop
+		self.length_multiplier = length_multiplier
+		# Path of the newest published snapshot
+		self.snapshot_path = None
+		self._executor = ProcessPoolExecutor(max_workers=workers)
+		# List of (key, future) waiting for a worker
+		self._queue = []
+		self._batches_in_flight = 0
+		# snapshot path : number of batches in flight against that snapshot
+		self._paths_in_use = {}
+
+	def publish(self, path):
+		'''
+		Sends all requests from now on to the snapshot at path
+		'''
+		self.snapshot_path = path
+
+	def is_in_use(self, path):
+		return path == self.snapshot_path or path in self._paths_in_use
+
+	async def generate_message(self, key):
+		'''
+		Generates a message from the model stored under key in the newest snapshot
+		Returns None if there is no such model
+		'''
+		future = self.loop.create_future()
+		self._queue.append((key, future))
+		self._dispatch()
+		return await future
+
+	def _dispatch(self):
+		while len(self._queue) > 0 and self._batches_in_flight < self.workers:
+			# Split the waiting requests evenly between the free workers
+			size = -(-len(self._queue) // (self.workers - self._batches_in_flight))
+			batch = self._queue[:size]
+			self._queue = self._queue[size:]
+
+			path = self.snapshot_path
+			self._batches_in_flight = self._batches_in_flight + 1
+			self._paths_in_use[path] = self._paths_in_use.get(path, 0) + 1
+			future = self.loop.run_in_executor(self._executor, generate_messages, path, [key for key, f in batch], self.length_multiplier)
+			future.add_done_callback(lambda f, path=path, batch=batch: self._finish_batch(f, path, batch))
+
+	def _finish_batch(self, future, path, batch):
+		self._batches_in_flight = self._batches_in_flight - 1
+		self._paths_in_use[path] = self._paths_in_use[path] - 1
+		if self._paths_in_use[path] == 0:
+			del self._paths_in_use[path]
+
+		try:
+			messages = future.result()
+		except OSError as e:
+			if path != self.snapshot_path:
+				# The snapshot could not be mapped but a newer one has been published since; retry against that one
+				self._queue[0:0] = batch
+			else:
+				self._fail(batch, e)
+		except Exception as e:
+			self._fail(batch, e)
+		else:
+			for (key, f), message in zip(batch, messages):
+				if not f.done():
+					f.set_result(message)
+		self._dispatch()
+
+	@staticmethod
+	def _fail(batch, e):
+		for key, f in batch:
+			if not f.done():
+				f.set_exception(e)
+
+	def shutdown(self):
+		self._executor.shutdown()